@@ -3,9 +3,16 @@ Driver for cloudlab.us website interaction and experiment provisioning
 """
 
 import re
+import copy
 import time
+import queue
+import contextvars
+import atexit
 import urllib
 import traceback
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
@@ -15,9 +22,68 @@ from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from execution.retry import retry
 from execution.log import with_logger
 
+CLOUDLAB_URL = "https://www.cloudlab.us"
 NOT_ENOUGH_REGEX = re.compile(
-    r'[0-9]+ nodes of type .+ requested, but only [0-9]+ available nodes of type .+ found')
-SSH_REGEX = re.compile(r'ssh -p [0-9]+ \S+@(\S+)')
+    r'\d+ nodes of type .+ requested, but only \d+ available nodes of type .+ found', re.ASCII)
+SSH_REGEX = re.compile(r'ssh -p \d+ \S+@(\S+)', re.ASCII)
+IMPLICIT_WAIT = 15
+SCRIPT_TIMEOUT = 60
+PENDING_STATUSES = frozenset(("created", "provisioning", "booting"))
+SET_VALUE_SCRIPT = """
+var elem = document.getElementById(arguments[0]);
+elem.value = arguments[1];
+elem.dispatchEvent(new Event('input', {bubbles: true}));
+elem.dispatchEvent(new Event('change', {bubbles: true}));
+"""
+TERMINATE_SCRIPT = """
+var done = arguments[arguments.length - 1];
+document.getElementById('terminate_button').click();
+var poll = setInterval(function () {
+    var confirm = document.querySelector('#terminate_modal #terminate');
+    if (confirm && confirm.offsetParent !== null) {
+        clearInterval(poll);
+        confirm.click();
+        done(true);
+    }
+}, 50);
+"""
+SSH_COMMANDS_SCRIPT = """
+return Array.from(document.querySelectorAll("td[name='sshurl'] kbd")).map(elem => elem.innerText);
+"""
+# Chrome flags that strip work unrelated to filling in forms and reading status text
+CHROME_ARGUMENTS = ["window-size=1920,1080", "--disable-gpu", "--disable-dev-shm-usage",
+                    "--blink-settings=imagesEnabled=false", "--disable-extensions",
+                    "--no-sandbox", "--disable-features=TranslateUI,MediaRouter,OptimizationHints"]
+# Block images and fonts at fetch time; stylesheets stay enabled so class-based selectors
+# keep matching
+CHROME_PREFS = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.managed_default_content_settings.fonts": 2,
+    "profile.managed_default_content_settings.stylesheets": 1,
+}
+
+# Idle browser sessions, kept around so that starting a session does not need to launch
+# a new chromedriver and browser each time
+_driver_pool = queue.Queue()  # pylint: disable=invalid-name
+
+
+def quit_pooled_drivers():
+    """
+    Quits every idle browser session; also runs at exit, which os._exit skips
+    """
+
+    while True:
+        try:
+            driver = _driver_pool.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+
+atexit.register(quit_pooled_drivers)
 
 
 class ProvisionedExperiment():
@@ -53,23 +119,173 @@ class Cloudlab():
     def __init__(self, username, password, headless):
         options = Options()
         options.headless = headless
-        options.add_argument("window-size=1920,1080")
-        self._driver = webdriver.Chrome(chrome_options=options)
-        self._driver.implicitly_wait(1)
+        for argument in CHROME_ARGUMENTS:
+            options.add_argument(argument)
+        options.add_experimental_option("prefs", CHROME_PREFS)
+        # Have driver.get() return on DOMContentLoaded instead of the full load event
+        options.set_capability("pageLoadStrategy", "eager")
+        self._options = options
         self._username = username
         self._password = password
-        self._authenticated = False
+        # Each thread drives its own browser session so that calls can run concurrently;
+        # the session cookies from the last login are shared to skip the login flow
+        self._local = threading.local()
+        self._drivers = []
+        self._drivers_lock = threading.Lock()
+        self._cookies = []
+        self._cookies_lock = threading.Lock()
+        self._terminations = None
+        self._terminations_lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def _driver(self):
+        driver = getattr(self._local, "driver", None)
+        if driver is None:
+            driver = self._acquire_driver()
+            with self._drivers_lock:
+                self._drivers.append(driver)
+            self._local.driver = driver
+            self._local.authenticated = self._restore_session(driver)
+        return driver
+
+    def _acquire_driver(self):
+        try:
+            driver = _driver_pool.get_nowait()
+        except queue.Empty:
+            driver = webdriver.Chrome(chrome_options=self._options)
+            driver.implicitly_wait(IMPLICIT_WAIT)
+            driver.set_script_timeout(SCRIPT_TIMEOUT)
+        else:
+            # Drop whatever session the pooled browser was last used with
+            driver.delete_all_cookies()
+        return driver
+
+    @property
+    def _authenticated(self):
+        return getattr(self._local, "authenticated", False)
+
+    @_authenticated.setter
+    def _authenticated(self, authenticated):
+        self._local.authenticated = authenticated
+
+    def _restore_session(self, driver):
+        # Snapshot, since another thread may be saving a newer login
+        with self._cookies_lock:
+            cookies = list(self._cookies)
+        if not cookies:
+            return False
+        # Cookies can only be added for the domain that is currently loaded
+        driver.get(CLOUDLAB_URL)
+        for cookie in cookies:
+            driver.add_cookie(cookie)
+        return True
+
+    def _save_session(self):
+        self._authenticated = True
+        cookies = self._driver.get_cookies()
+        # Updated in place so that handles from session() share the login
+        with self._cookies_lock:
+            self._cookies[:] = cookies
+
+    def session(self, logger):
+        """
+        Returns a handle sharing this instance's browser sessions and login that logs to the
+        given logger
+        """
+
+        handle = copy.copy(self)
+        handle.set_logger(logger)
+        return handle
+
+    def submit_terminate(self, experiment, logger=None, retry_count=5):
+        """
+        Queues the experiment for termination on a single background worker and returns a
+        future for the result; terminations run one at a time, in submission order. Raises
+        a RuntimeError once the driver is closing
+        """
+
+        with self._terminations_lock:
+            if self._closed:
+                raise RuntimeError("Cloudlab driver is closed")
+            if self._terminations is None:
+                self._terminations = ThreadPoolExecutor(max_workers=1,
+                                                        thread_name_prefix="terminate")
+            handle = self if logger is None else self.session(logger)
+            # Run in the caller's context so that its log prefix carries over
+            return self._terminations.submit(contextvars.copy_context().run, handle.terminate,
+                                             experiment, retry_count)
+
+    def release(self):
+        """
+        Returns the calling thread's browser session to the shared pool
+        """
+
+        driver = getattr(self._local, "driver", None)
+        if driver is not None:
+            self._local.driver = None
+            with self._drivers_lock:
+                self._drivers.remove(driver)
+            _driver_pool.put(driver)
+
+    def close(self):
+        """
+        Waits for queued terminations, then returns every browser session opened by this
+        instance to the shared pool
+        """
+
+        with self._terminations_lock:
+            self._closed = True
+            terminations, self._terminations = self._terminations, None
+        if terminations is not None:
+            terminations.shutdown(wait=True)
+        with self._drivers_lock:
+            drivers, self._drivers = self._drivers, []
+        for driver in drivers:
+            _driver_pool.put(driver)
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    @contextmanager
+    def _suspend_implicit_wait(self):
+        # Explicit waits poll through find_element, so the implicit wait would otherwise
+        # stall every single poll for its full duration
+        self._driver.implicitly_wait(0)
+        try:
+            yield
+        finally:
+            self._driver.implicitly_wait(IMPLICIT_WAIT)
+
+    def _wait_until(self, condition, timeout=60, poll_frequency=0.5):
+        with self._suspend_implicit_wait():
+            return WebDriverWait(self._driver, timeout,
+                                 poll_frequency=poll_frequency).until(condition)
+
+    def _wait_loaded(self, timeout=60):
+        # The load timing entry is set as soon as the event fires, so already-loaded
+        # pages resolve on the first poll
+        script = "return (performance.timing.loadEventEnd > 0) || document.readyState === 'complete'"
+        self._wait_until(lambda driver: driver.execute_script(script), timeout)
+
+    def _set_value(self, element_id, value):
+        # Fills the input inside the page in a single round-trip instead of
+        # separate click/clear/send_keys commands
+        self._driver.execute_script(SET_VALUE_SCRIPT, element_id, value)
 
     def login(self, retry_count=5):
         driver = self._driver
         task = "log into Cloudlab"
         for current in retry(retry_count, task=task, logger=self.logger):  # pylint: disable=unexpected-keyword-arg
-            driver.get("https://www.cloudlab.us/login.php")
-            WebDriverWait(driver, 60).until(lambda driver: driver.execute_script(
-                'return document.readyState') == 'complete')
+            driver.get(f"{CLOUDLAB_URL}/login.php")
+            self._wait_loaded(60)
 
             if 'User Dashboard' in driver.title:
-                self._authenticated = True
+                self._save_session()
                 return
             elif 'Login' in driver.title:
                 self._authenticated = False
@@ -79,19 +295,19 @@ class Cloudlab():
                 continue
 
             try:
-                driver.find_element(By.NAME, "uid").click()
-                driver.find_element(By.NAME, "uid").send_keys(self._username)
+                uid = driver.find_element(By.NAME, "uid")
+                uid.click()
+                uid.send_keys(self._username)
                 driver.find_element(By.NAME, "password").send_keys(self._password)
                 driver.find_element(By.NAME, "login").click()
             except Exception as ex:
                 current.failed("could not interact with login form", ex)
                 continue
 
-            WebDriverWait(driver, 60).until(lambda driver: driver.execute_script(
-                'return document.readyState') == 'complete')
+            self._wait_loaded(60)
 
             if 'User Dashboard' in driver.title:
-                self._authenticated = True
+                self._save_session()
                 return
             elif 'Login' not in driver.title:
                 url, title = driver.current_url, driver.title
@@ -109,9 +325,8 @@ class Cloudlab():
                 continue
 
             driver.get(
-                f"https://www.cloudlab.us/status.php?uuid={experiment.uuid()}")
-            WebDriverWait(driver, 60).until(lambda driver: driver.execute_script(
-                'return document.readyState') == 'complete')
+                f"{CLOUDLAB_URL}/status.php?uuid={experiment.uuid()}")
+            self._wait_loaded(60)
             # Make sure we're authenticated
             if 'Login' in driver.title:
                 self._authenticated = False
@@ -123,33 +338,25 @@ class Cloudlab():
 
             # Expand header if collapsed
             try:
-                WebDriverWait(driver, 60).until(expected_conditions.visibility_of_element_located(
+                self._wait_until(expected_conditions.visibility_of_element_located(
                     (By.ID, "terminate_button")))
             except (NoSuchElementException, TimeoutException):
-                WebDriverWait(driver, 60).until(expected_conditions.presence_of_element_located(
-                    (By.XPATH, "//a[@id='profile_status_toggle']")))
                 driver.find_element(
                     By.XPATH, "//a[@id='profile_status_toggle']").click()
-                WebDriverWait(driver, 60).until(expected_conditions.visibility_of_element_located(
-                    (By.ID, "terminate_button")))
                 try:
-                    term_button = driver.find_element_by_id("terminate_button")
-                except NoSuchElementException as ex:
+                    self._wait_until(expected_conditions.visibility_of_element_located(
+                        (By.ID, "terminate_button")))
+                except TimeoutException as ex:
                     current.failed(
                         f"terminate button could not be found even after expanding", ex)
                     continue
 
             try:
-                # Click terminate and confirm
-                WebDriverWait(driver, 240).until(expected_conditions.element_to_be_clickable(
-                    (By.ID, "terminate_button")))
-                term_button = driver.find_element_by_id("terminate_button")
-                term_button.click()
-                WebDriverWait(driver, 60).until(expected_conditions.element_to_be_clickable(
-                    (By.CSS_SELECTOR, "#terminate_modal #terminate")))
-                driver.find_element_by_css_selector(
-                    "#terminate_modal #terminate").click()
-            except TimeoutError:
+                # Click terminate and then confirm once the modal is shown, all inside the page
+                self._wait_until(expected_conditions.element_to_be_clickable(
+                    (By.ID, "terminate_button")), 240)
+                driver.execute_async_script(TERMINATE_SCRIPT)
+            except TimeoutException as ex:
                 current.failed("could not wait on terminate pathway to become clickable", ex)
             else:
                 self.info("Terminated experiment %s", experiment)
@@ -166,9 +373,8 @@ class Cloudlab():
                 current.failed("could not log in", ex)
                 continue
 
-            driver.get("https://www.cloudlab.us/instantiate.php")
-            WebDriverWait(driver, 60).until(lambda driver: driver.execute_script(
-                'return document.readyState') == 'complete')
+            driver.get(f"{CLOUDLAB_URL}/instantiate.php")
+            self._wait_loaded(60)
 
             # Make sure we're authenticated
             if "Login" in driver.title:
@@ -180,42 +386,37 @@ class Cloudlab():
                     continue
 
             try:
-                WebDriverWait(driver, 60).until(expected_conditions.element_to_be_clickable(
+                self._wait_until(expected_conditions.element_to_be_clickable(
                     (By.ID, "change-profile")))
                 driver.find_element(By.ID, "change-profile").click()
                 try:
                     # Wait for page to select initial profile (otherwise the selection will be cleared)
-                    WebDriverWait(driver, 60).until(expected_conditions.presence_of_element_located(
-                        (By.CSS_SELECTOR, "li.profile-item.selected")))
-                except TimeoutException:
+                    driver.find_element(By.CSS_SELECTOR, "li.profile-item.selected")
+                except NoSuchElementException:
                     # Ignore timeouts here
                     pass
                 driver.find_element(
                     By.XPATH, f"//li[@name='{profile}']").click()
-                WebDriverWait(driver, 60).until(expected_conditions.presence_of_element_located(
-                    (By.XPATH, f"//li[@name='{profile}' and contains(@class, 'selected')]")))
+                driver.find_element(
+                    By.XPATH, f"//li[@name='{profile}' and contains(@class, 'selected')]")
                 driver.find_element(
                     By.XPATH, "//button[contains(text(),'Select Profile')]").click()
-                WebDriverWait(driver, 60).until(expected_conditions.element_to_be_clickable(
+                self._wait_until(expected_conditions.element_to_be_clickable(
                     (By.LINK_TEXT, "Next")))
                 driver.find_element(By.LINK_TEXT, "Next").click()
 
                 # Set name if given
                 if name is not None:
-                    driver.find_element(By.ID, "experiment_name").click()
-                    driver.find_element(
-                        By.ID, "experiment_name").send_keys(name)
+                    driver.find_element(By.ID, "experiment_name")
+                    self._set_value("experiment_name", name)
 
-                WebDriverWait(driver, 60).until(expected_conditions.element_to_be_clickable(
+                self._wait_until(expected_conditions.element_to_be_clickable(
                     (By.LINK_TEXT, "Next")))
                 driver.find_element(By.LINK_TEXT, "Next").click()
-                WebDriverWait(driver, 60).until(expected_conditions.element_to_be_clickable(
+                self._wait_until(expected_conditions.element_to_be_clickable(
                     (By.ID, "experiment_duration")))
-                driver.find_element(By.ID, "experiment_duration").click()
-                driver.find_element(By.ID, "experiment_duration").clear()
-                driver.find_element(
-                    By.ID, "experiment_duration").send_keys(str(expires_in))
-                WebDriverWait(driver, 60).until(expected_conditions.element_to_be_clickable(
+                self._set_value("experiment_duration", str(expires_in))
+                self._wait_until(expected_conditions.element_to_be_clickable(
                     (By.LINK_TEXT, "Finish")))
                 driver.find_element(By.LINK_TEXT, "Finish").click()
             except Exception as ex:
@@ -224,10 +425,8 @@ class Cloudlab():
 
             try:
                 # Wait until the info page has been loaded
-                WebDriverWait(driver, 60).until(
-                    expected_conditions.title_contains("Experiment Status"))
-                WebDriverWait(driver, 60).until(lambda driver: driver.execute_script(
-                    'return document.readyState') == 'complete')
+                self._wait_until(expected_conditions.title_contains("Experiment Status"))
+                self._wait_loaded(60)
             except TimeoutException as ex:
                 # Can't really clean up if an error ocurrs here, so hope it doesn't
                 if 'Login' in driver.title:
@@ -245,9 +444,7 @@ class Cloudlab():
             # Consider the experiment provisioned here, so any failures from here on need
             # to be cleaned up (experiment terminated)
             name_xpath = "//td[contains(.,'Name:')]/following-sibling::td"
-            WebDriverWait(driver, 60).until(
-                expected_conditions.presence_of_element_located((By.XPATH, name_xpath)))
-            WebDriverWait(driver, 60).until(
+            self._wait_until(
                 lambda driver: driver.find_element_by_xpath(name_xpath).text.strip() != '')
             exp_name = driver.find_element_by_xpath(name_xpath).text
             url_parts = urllib.parse.urlparse(driver.current_url)
@@ -261,41 +458,41 @@ class Cloudlab():
             if status != "ready":
                 self.debug(f"Waiting for experiment to become ready")
 
+            def settled_status(driver):
+                # Returns the status once it leaves the pending states so that the poll
+                # itself yields it, without a second read after the wait
+                current_status = driver.find_element_by_xpath(status_xpath).text
+                return current_status if current_status not in PENDING_STATUSES else False
+
             failed = False
             while status != "ready":
                 try:
-                    WebDriverWait(driver, 60).until(
-                        expected_conditions.text_to_be_present_in_element((By.XPATH, status_xpath),
-                                                                          "ready"))
+                    # Status transitions take tens of seconds, so poll sparingly
+                    status = self._wait_until(settled_status, poll_frequency=2.0)
                 except TimeoutException:
-                    status = driver.find_element_by_xpath(status_xpath).text
-                    if status == "terminating":
-                        # Already terminating; back off for 5 minutes and try again
-                        current.failed("experiment is marked as terminating")
-                        failed = True
-                        break
-                    elif status == "ready":
-                        break
-                    elif status == 'created' or status == 'provisioning' or status == 'booting':
-                        # Good; keep waiting
-                        continue
+                    # Good; keep waiting
+                    continue
+
+                if status == "terminating":
+                    # Already terminating; back off for 5 minutes and try again
+                    current.failed("experiment is marked as terminating")
+                    failed = True
+                    break
+                elif status != "ready":
+                    # If "failed" or otherwise, assume failure; need to clean up
+                    # Try to extract error
+                    cloudlab_error = self.get_error_text()
+                    self.error("Experiment is marked as %s: stopping; trying to terminate. %s",
+                               status, self.get_error_text())
+                    self.safe_terminate(experiment, retry_count=retry_count)
+                    if "Resource reservation violation" in cloudlab_error:
+                        current.failed('resource reservation violation')
+                    elif ("requested, but only" in cloudlab_error
+                          and NOT_ENOUGH_REGEX.search(cloudlab_error)):
+                        current.failed('insufficient nodes available')
                     else:
-                        # If "failed" or otherwise, assume failure; need to clean up
-                        # Try to extract error
-                        cloudlab_error = self.get_error_text()
-                        self.error("Experiment is marked as %s: stopping; trying to terminate. %s",
-                                   status, self.get_error_text())
-                        self.safe_terminate(experiment, retry_count=retry_count)
-                        if "Resource reservation violation" in cloudlab_error:
-                            current.failed('resource reservation violation')
-                        elif re.search(NOT_ENOUGH_REGEX, cloudlab_error):
-                            current.failed('insufficient nodes available')
-                        else:
-                            current.failed('error during provisioning')
-                        failed = True
-                        break
-                else:
-                    status = "ready"
+                        current.failed('error during provisioning')
+                    failed = True
                     break
 
             if failed or status != "ready":
@@ -303,7 +500,7 @@ class Cloudlab():
 
             try:
                 # Navigate to list panel
-                WebDriverWait(driver, 60).until(
+                self._wait_until(
                     expected_conditions.visibility_of_element_located((By.ID, "show_listview_tab")))
                 driver.find_element(By.ID, "show_listview_tab").click()
             except (TimeoutException, NoSuchElementException) as ex:
@@ -318,8 +515,12 @@ class Cloudlab():
                 continue
 
             # Should be ready here, read hostnames
-            ssh_commands = [elem.text for elem in driver.find_elements_by_xpath(
-                "//td[@name='sshurl']//kbd")]
+            # Read every ssh command in one round-trip rather than one per host
+            try:
+                ssh_commands = self._wait_until(
+                    lambda driver: driver.execute_script(SSH_COMMANDS_SCRIPT), IMPLICIT_WAIT)
+            except TimeoutException:
+                ssh_commands = []
             if not ssh_commands:
                 current.failed("parsed hostnames list was empty")
                 error_text = self.get_error_text()
@@ -328,15 +529,33 @@ class Cloudlab():
                 self.debug("Terminating experiment %s", experiment)
                 self.safe_terminate(experiment, retry_count=retry_count)
                 continue
-            hostnames = []
-            for ssh_command in ssh_commands:
-                match_obj = re.search(SSH_REGEX, ssh_command)
-                if match_obj:
-                    hostnames.append(match_obj.group(1))
+            ssh_search = SSH_REGEX.search
+            hostnames = [match_obj.group(1)
+                         for match_obj in map(ssh_search, ssh_commands) if match_obj]
 
             # Experiment successfully provisioned, hostnames extracted
             return Experiment(experiment.uuid(), experiment.name(), experiment.profile(), hostnames)
 
+    def provision_many(self, experiments, expires_in=5, retry_count=5, max_workers=None):
+        """
+        Provisions each (profile, name) pair concurrently, each worker thread using its
+        own browser session, and returns the experiments in the same order
+        """
+
+        experiments = list(experiments)
+        with ThreadPoolExecutor(max_workers=max_workers or len(experiments) or 1,
+                                thread_name_prefix="provision") as pool:
+            futures = [pool.submit(self._provision_and_release, profile, name=name,
+                                   expires_in=expires_in, retry_count=retry_count)
+                       for (profile, name) in experiments]
+            return [future.result() for future in futures]
+
+    def _provision_and_release(self, profile, **kwargs):
+        try:
+            return self.provision(profile, **kwargs)
+        finally:
+            self.release()
+
     def safe_terminate(self, experiment, retry_count=5):
         try:
             self.terminate(experiment, retry_count)
@@ -350,7 +569,7 @@ class Cloudlab():
         top_status = driver.find_element_by_id("status_message").text
         if top_status == "Something went wrong!":
             try:
-                WebDriverWait(driver, 60).until(
+                self._wait_until(
                     expected_conditions.visibility_of_element_located((By.ID, "error_panel")))
             except TimeoutException:
                 return None
@@ -5,18 +5,16 @@ the automation script (mainly, communicating termination to all threads).
 
 import threading
 
-stopping = False # pylint: disable=invalid-name
-term_cond = threading.Condition() # pylint: disable=invalid-name
+_stop_event = threading.Event()  # pylint: disable=invalid-name
 
 
 def wait(delay):
-    term_cond.acquire()
-    term_cond.wait(timeout=delay)
-    term_cond.release()
-    return stopping
+    return _stop_event.wait(delay)
+
+
+def stopping():
+    return _stop_event.is_set()
 
 
 def stop():
-    term_cond.acquire()
-    term_cond.notify_all()
-    term_cond.release()
+    _stop_event.set()
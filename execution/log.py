@@ -2,8 +2,10 @@
 Logging utilities for indenting, formatting, and wrapping existing loggers
 """
 
-import os
 import time
+import shutil
+import contextvars
+import logging
 import functools
 import textwrap
 import logzero
@@ -23,6 +25,8 @@ class LogFormatter(logzero.LogFormatter):
         self._inner = inner
         self._indent = indent
         self._prefix = prefix
+        self._columns = None
+        self._wrapping = {}
 
     def format_time(self, record, datefmt=None):
         created = self.converter(record.created)
@@ -33,6 +37,35 @@ class LogFormatter(logzero.LogFormatter):
             formatted = "%s.%03d" % (date_str, record.msecs)
         return formatted
 
+    def columns(self):
+        # Resolved on first use rather than at import, which also works without a tty
+        if self._columns is None:
+            self._columns = shutil.get_terminal_size((80, 24)).columns
+        return self._columns
+
+    def wrapping(self, inner_indent):
+        # The indent width only varies with the prefix length, so the indent string and
+        # wrapper are built once per width rather than on every record
+        wrapping = self._wrapping.get(inner_indent)
+        if wrapping is None:
+            width = self.columns() - inner_indent
+            wrapping = (" " * inner_indent, width, textwrap.TextWrapper(width=width))
+            self._wrapping[inner_indent] = wrapping
+        return wrapping
+
+    def indented_lines(self, message, inner_indent):
+        # Drops blank-only lines, wraps long ones and indents everything after the first
+        # line in a single pass
+        indent, effective_width, wrapper = self.wrapping(inner_indent)
+        is_first = True
+        for line in message.splitlines():
+            if not line.strip():
+                continue
+            wrapped = wrapper.wrap(line) if len(line) > effective_width else (line,)
+            for wrapped_line in wrapped:
+                yield wrapped_line if is_first else indent + wrapped_line
+                is_first = False
+
     def format(self, record):
         try:
             message = record.getMessage()
@@ -59,27 +92,12 @@ class LogFormatter(logzero.LogFormatter):
 
         record.levelname = custom_levelname(record.levelname)
         record.inner = self._inner % record.__dict__
-        # Remove all blank-only lines
-        lines = [line for line in record.message.splitlines()
-                 if len(line.strip()) > 0]
-
         if self._indent:
             inner_indent = len(record.inner) + len(record.prefix) + 1
-            indent = " " * inner_indent
-            new_lines = []
-            effective_width = int(COLUMNS) - inner_indent
-            for i, line in enumerate(lines):
-                wrapped = None
-                if len(line) > effective_width:
-                    wrapped = textwrap.wrap(line, effective_width)
-                else:
-                    wrapped = [line]
-                for j, wrapped_line in enumerate(wrapped):
-                    if i != 0 or j != 0:
-                        new_lines.append(indent + wrapped_line)
-                    else:
-                        new_lines.append(wrapped_line)
-            lines = new_lines
+            lines = self.indented_lines(record.message, inner_indent)
+        else:
+            # Remove all blank-only lines
+            lines = (line for line in record.message.splitlines() if line.strip())
 
         record.message = "\n".join(lines)
         formatted = self._fmt % record.__dict__
@@ -102,55 +120,70 @@ def custom_levelname(name):
         return name[:4]
 
 
-def setup_logger(colors=True, inner=None, indent=True, prefix=None, **kwargs):
-    new_logger = logzero.setup_logger(formatter=LogFormatter(
-        colors=colors, indent=indent, prefix=prefix), **kwargs)
-    if inner is not None:
-        setattr(new_logger, "inner", inner)
-    return new_logger
+class Lazy:
+    """
+    Log argument computed only if the record is actually formatted
+    """
 
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
 
-def _log(logger, level, message, *args, external=False, internal=False, **kwargs):
-    picked_logger = None
-    if internal:
-        if logger != log:
-            picked_logger = logger
-    elif external:
-        picked_logger = log
-        try:
-            # attempt to extract inner logger if valid
-            inner = logger.inner
-            if inner is not None:
-                picked_logger = inner
-        except:
-            pass
-    else:
-        picked_logger = logger
+    def __str__(self):
+        return str(self._func(*self._args))
 
-    if picked_logger is not None:
-        method = getattr(picked_logger, level)
-        if method is not None:
-            method(message, *args, **kwargs)
 
+# Id of the test being worked on, shown as a prefix on the shared logger's records
+current_test = contextvars.ContextVar("current_test", default=None)
 
-def info(logger, message, *args, external=False, internal=False, **kwargs):
-    _log(logger, "info", message, *args, external=external, internal=internal, **kwargs)
 
+class TestPrefixFilter(logging.Filter):
+    """
+    Prefixes records with the current test id (when there is one)
+    """
 
-def error(logger, message, *args, external=False, internal=False, **kwargs):
-    _log(logger, "error", message, *args, external=external, internal=internal, **kwargs)
+    def filter(self, record):
+        test_id = current_test.get()
+        if test_id is not None and not hasattr(record, "prefix"):
+            record.prefix = f"[{test_id}] "
+        return True
 
 
-def debug(logger, message, *args, external=False, internal=False, **kwargs):
-    _log(logger, "debug", message, *args, external=external, internal=internal, **kwargs)
+def setup_logger(colors=True, inner=None, indent=True, prefix=None, **kwargs):
+    new_logger = logzero.setup_logger(formatter=LogFormatter(
+        colors=colors, indent=indent, prefix=prefix), **kwargs)
+    if inner is not None:
+        setattr(new_logger, "inner", inner)
+    return new_logger
+
 
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'fatal': logging.FATAL,
+}
 
-def warning(logger, message, *args, external=False, internal=False, **kwargs):
-    _log(logger, "warning", message, *args, external=external, internal=internal, **kwargs)
 
+def _make_log_method(level):
+    # Unbound so that each call skips the getattr on the picked logger
+    method = getattr(logging.Logger, level)
+    levelno = LEVELS[level]
+
+    def log_method(self, message, *args, external=False, internal=False, **kwargs):
+        if external:
+            picked_logger = self._external_logger
+        elif internal:
+            picked_logger = self._internal_logger
+        else:
+            picked_logger = self._logger
+
+        if picked_logger is not None and picked_logger.isEnabledFor(levelno):
+            method(picked_logger, message, *args, **kwargs)
 
-def fatal(logger, message, *args, external=False, internal=False, **kwargs):
-    _log(logger, "fatal", message, *args, external=external, internal=internal, **kwargs)
+    log_method.__name__ = level
+    return log_method
 
 
 def with_logger(cls):
@@ -162,34 +195,23 @@ def with_logger(cls):
         self.logger = logger
         old_init(self, *args, **kwargs)
 
-    def _info(self, message, *args, external=False, internal=False, **kwargs):
-        info(self.logger, message, *args, external=external, internal=internal, **kwargs)
-
-    def _error(self, message, *args, external=False, internal=False, **kwargs):
-        error(self.logger, message, *args, external=external, internal=internal, **kwargs)
-
-    def _debug(self, message, *args, external=False, internal=False, **kwargs):
-        debug(self.logger, message, *args, external=external, internal=internal, **kwargs)
-
-    def _warning(self, message, *args, external=False, internal=False, **kwargs):
-        warning(self.logger, message, *args, external=external, internal=internal, **kwargs)
-
-    def _fatal(self, message, *args, external=False, internal=False, **kwargs):
-        fatal(self.logger, message, *args, external=external, internal=internal, **kwargs)
+    def get_logger(self):
+        return self._logger
 
     def set_logger(self, logger):
-        self.logger = logger
-
-    setattr(cls, 'info', _info)
-    setattr(cls, 'error', _error)
-    setattr(cls, 'debug', _debug)
-    setattr(cls, 'warning', _warning)
-    setattr(cls, 'fatal', _fatal)
+        # Resolve the internal/external targets once per logger instead of per call
+        self._logger = logger
+        self._internal_logger = logger if logger is not log else None
+        self._external_logger = getattr(logger, "inner", None) or log
+
+    setattr(cls, 'logger', property(get_logger, set_logger))
+    for level in LEVELS:
+        setattr(cls, level, _make_log_method(level))
     setattr(cls, 'set_logger', set_logger)
     setattr(cls, '__init__', __init__)
     return cls
 
 
-_, COLUMNS = os.popen('stty size', 'r').read().split()
 logzero.formatter(LogFormatter())
 log = log  # pylint: disable=invalid-name, self-assigning-variable
+log.addFilter(TestPrefixFilter())
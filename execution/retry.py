@@ -3,6 +3,9 @@ Constructs for implementing resilient retry loops for potentially fallible
 actions
 """
 
+import sys
+import random
+import logging
 import traceback
 from execution.control import wait
 from execution.log import with_logger
@@ -10,33 +13,45 @@ from execution.exceptions import OperationFailed, ExitEarly
 
 
 class BackoffPolicy():
-    # pylint: disable=no-self-argument, invalid-name
+    # pylint: disable=invalid-name
+    @staticmethod
     def CONSTANT(index, backoff_duration):
         return backoff_duration
 
+    @staticmethod
     def LINEAR(factor=0.5):
         def policy(index, backoff_duration):
             return backoff_duration * (1 + (factor * index))
         return policy
 
+    @staticmethod
     def QUADRATIC(factor=0.5):
         def policy(index, backoff_duration):
             return backoff_duration * (1 + (factor * (index ** 2)))
         return policy
 
+    @staticmethod
+    def EXPONENTIAL(factor=2.0, max_delay=120.0):
+        def policy(index, backoff_duration):
+            return min(max_delay, backoff_duration * (factor ** index))
+        return policy
+
 
 @with_logger
 class retry():  # pylint: disable=invalid-name
     def __init__(self, retry_count=5, task="task", backoff_duration=60,
-                 backoff_policy=BackoffPolicy.QUADRATIC(factor=0.5)):
+                 backoff_policy=BackoffPolicy.QUADRATIC(factor=0.5), jitter=False):
         self._retry_count = retry_count
-        self._backoff_policy = backoff_policy
-        self._backoff_duration = backoff_duration
+        # The number of attempts is fixed, so every backoff delay is known up front
+        self._delays = [backoff_policy(i, backoff_duration) for i in range(retry_count + 1)]
+        # Spreads out retries of loops that failed at the same time (e.g. many threads
+        # hitting the same host) so that they do not retry in lockstep
+        self._jitter = jitter
         self._index = -1
         self._task = task
         self._failure_msg = None
         self._cause = None
-        self._trace = None
+        self._exc_info = None
 
     def __iter__(self):
         return self
@@ -60,11 +75,12 @@ class retry():  # pylint: disable=invalid-name
             self._failure_msg = message
             self._cause = cause
 
+        # Only keep the exception info here; the traceback is formatted later, and only
+        # if it is actually going to be logged
         if self._cause is not None and isinstance(self._cause, Exception):
-            try:
-                self._trace = traceback.format_exc()
-            except:
-                pass
+            exc_info = sys.exc_info()
+            if exc_info[0] is not None:
+                self._exc_info = exc_info
 
     def is_last(self):
         return self._index >= self._retry_count + 1
@@ -91,8 +107,9 @@ class retry():  # pylint: disable=invalid-name
 
         # otherwise, if this is not the first iteration, report a failure
         if self._index != 0:
-            retry_delay = self._backoff_policy(
-                self._index, self._backoff_duration)
+            retry_delay = self._delays[self._index]
+            if self._jitter:
+                retry_delay = random.uniform(retry_delay / 2, retry_delay)
             retry_text = "retrying in {:.1f} {}".format(
                 retry_delay, "seconds" if retry_delay != 1 else "second")
             attempt_text = f" after the {self.attempt_str()}"
@@ -108,14 +125,14 @@ class retry():  # pylint: disable=invalid-name
             else:
                 self.warning("Failed to %s%s; %s", self._task, failure_text, retry_text)
             # Print cause exception if valid
-            if self._cause is not None:
+            if self._cause is not None and self.logger.isEnabledFor(logging.DEBUG):
                 trace_msg = ""
-                if self._trace is not None:
-                    trace_msg = f"\n{self._trace}"
+                if self._exc_info is not None:
+                    trace_msg = "\n" + "".join(traceback.format_exception(*self._exc_info))
                 self.debug("Caused by:\n%s%s", repr(self._cause), trace_msg)
             self._failure_msg = None
             self._cause = None
-            self._trace = None
+            self._exc_info = None
 
             # Sleep for the backoff duration
             if wait(retry_delay):
@@ -2,17 +2,134 @@
 Classes related to test description and execution
 """
 
+import os
+import re
+import uuid
 import json
+import shlex
+import hashlib
+import contextvars
+import functools
 import threading
+import subprocess
 from os import path
-import pexpect
+from posixpath import join as rjoin
+from contextlib import contextmanager
+from pathlib import Path
 from pexpect import pxssh
 from pprint import pformat
-from execution.retry import retry
-from execution.control import wait, stopping
-from execution.log import with_logger, setup_logger
+from execution.retry import retry, BackoffPolicy
+from execution.control import stopping
+from execution.log import with_logger, setup_logger, Lazy
 from execution.exceptions import OperationFailed, ExitEarly
 
+# Remote folder the experiment repo is cloned into
+REMOTE_FOLDER = "repo"
+# Kept short since unix socket paths are limited to ~108 characters
+CONTROL_DIR = path.expanduser("~/.ssh/cm")
+
+
+# Sessions per connection allowed by sshd (its MaxSessions default)
+MAX_SESSIONS = 10
+# Concurrent ssh handshakes across all threads, kept under sshd's MaxStartups (10 by
+# default) past which new connections are randomly dropped
+_HANDSHAKE_GATE = threading.BoundedSemaphore(int(os.environ.get("MAX_SSH_HANDSHAKES", "8")))
+# Bytes per sftp read/write request; larger buffers need fewer round-trips but must
+# stay under the 256 KiB maximum sftp message length
+SFTP_BUFFER_SIZE = 131072
+
+
+# Remote operations mostly fail on transient network glitches, so the first retry comes
+# after a second or two and later ones back off exponentially up to a minute
+SSH_BACKOFF = dict(backoff_duration=1, backoff_policy=BackoffPolicy.EXPONENTIAL(max_delay=60),
+                   jitter=True)
+
+
+def control_path(username, hostname):
+    digest = hashlib.sha1(f"{username}@{hostname}".encode()).hexdigest()[:8]
+    return path.join(CONTROL_DIR, f"{digest}.sock")
+
+
+def sftp_quote(value):
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+class SharedMaster:
+    """
+    ssh control master shared by every test running against the same host
+    """
+
+    def __init__(self, username, hostname):
+        self._key = (username, hostname)
+        self._destination = f"{username}@{hostname}"
+        self._control_path = control_path(username, hostname)
+        self._users = 0
+        self._lock = threading.Lock()
+        self._sessions = threading.BoundedSemaphore(MAX_SESSIONS)
+
+    def key(self):
+        return self._key
+
+    def destination(self):
+        return self._destination
+
+    def control_path(self):
+        return self._control_path
+
+    def lock(self):
+        return self._lock
+
+    def sessions(self):
+        return self._sessions
+
+    def attach(self):
+        self._users += 1
+        return self._users
+
+    def detach(self):
+        self._users -= 1
+        return self._users
+
+    def control(self, command, timeout=30):
+        args = ["ssh", "-O", command, "-o", f"ControlPath={self._control_path}",
+                self._destination]
+        try:
+            result = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        return result.returncode == 0
+
+    def alive(self):
+        return self.control("check")
+
+    def stop(self):
+        return self.control("exit")
+
+
+# Control masters by (username, hostname)
+_SSH_POOL = {}
+_SSH_POOL_LOCK = threading.Lock()
+
+
+def acquire_master(username, hostname):
+    with _SSH_POOL_LOCK:
+        master = _SSH_POOL.get((username, hostname))
+        if master is None:
+            master = SharedMaster(username, hostname)
+            _SSH_POOL[master.key()] = master
+        master.attach()
+        return master
+
+
+def release_master(master):
+    # Stopped under the pool lock so a concurrent acquire can't pick up a dying master
+    with _SSH_POOL_LOCK:
+        if master.detach() == 0:
+            del _SSH_POOL[master.key()]
+            master.stop()
+
 
 class TestReplica:
     def __init__(self, test_id, options, experiment, profile, matrix_ids=None, config={}):
@@ -22,6 +139,8 @@ class TestReplica:
         self._profile = profile
         self._matrix_ids = matrix_ids
         self._config = config
+        # Replicas are not modified after construction, so they are described at most once
+        self._repr = None
 
     def config(self):
         return self._config
@@ -42,6 +161,11 @@ class TestReplica:
         return self._matrix_ids
 
     def __repr__(self):
+        if self._repr is None:
+            self._repr = self._describe()
+        return self._repr
+
+    def _describe(self):
         lines = []
         lines.append(f"experiment: {self._experiment}")
         lines.append(f"profile: {self._profile}")
@@ -54,10 +178,13 @@ class TestReplica:
 
 
 @with_logger
-class TestExecutionThread(threading.Thread):
+class TestExecution:
+    """
+    Sets up, executes and tears down a single test replica on the calling thread
+    """
+
     def __init__(self, test, hostname, config_path, results_path, log_path,
-                 config, experiment, cloudlab, cloudlab_lock):
-        threading.Thread.__init__(self)
+                 config, experiment, cloudlab):
         self._test = test
         self._hostname = hostname
         self._config_path = config_path
@@ -65,68 +192,143 @@ class TestExecutionThread(threading.Thread):
         # Merge the test config & the global config
         self._config = {**config, **test.config()}
         self._experiment = experiment
-        self._remote_experiment_path = None
+        # Remote paths are always POSIX, whatever the local platform
+        self._remote_experiment_path = rjoin(REMOTE_FOLDER,
+                                             self._config.get("experiments_path", "experiments"),
+                                             test.experiment())
         self._cloudlab_driver = cloudlab
-        self._cloudlab_lock = cloudlab_lock
+        self._master = None
+        self._cert_path = path.abspath(path.expanduser(self._config.get("ssh_cert", "id_rsa")))
+        self._username = self._config.get("username", "root")
+        self._retry_delay = self._config.get("retry_delay", 120)
+        self._destination = f"{self._username}@{hostname}"
+        # Every ssh/sftp invocation for the host shares one multiplexed connection
+        self._mux_options = dict(ControlMaster="auto",
+                                 ControlPath=control_path(self._username, hostname),
+                                 ControlPersist="10m")
+        self._ssh_prelude = ('-o', 'UserKnownHostsFile=/dev/null',
+                             '-o', 'StrictHostKeyChecking=no',
+                             *self._mux_args(),
+                             '-i', self._cert_path)
+        self._sftp_prelude = (*self._ssh_prelude, '-B', str(SFTP_BUFFER_SIZE))
         self.logger = setup_logger(inner=self.logger, logfile=log_path, name=f"{self._test.id()}-f",
                                    disableStderrLogger=True, colors=False, indent=False)
 
-    def transfer(self, local_src=None, local_dest=None, remote_path=None, retry_count=1):
-        cert_path = self._config.get("ssh_cert", "id_rsa")
-        username = self._config.get("username", "root")
-        retry_delay = self._config.get("retry_delay", 120)
-
-        prelude = ['-o', 'UserKnownHostsFile=/dev/null',
-                   '-o', 'StrictHostKeyChecking=no',
-                   '-i', cert_path]
-        hoststring = f"{username}@{self._hostname}:{remote_path}"
-
-        to_remote = False
-        if local_src is None:
-            # Transfer from remote
-            args = [*prelude, hoststring, local_dest]
-        else:
-            # Transfer to remote
-            to_remote = True
-            args = [*prelude, local_src, hoststring]
-
-        transfer_local = local_src if to_remote else local_dest
-        transfer_text = f"'{transfer_local}' {'to' if to_remote else 'from'}"
+    def _mux_args(self):
+        return [arg for (key, value) in self._mux_options.items()
+                for arg in ('-o', f"{key}={value}")]
+
+    def _open_mux(self):
+        self._master = acquire_master(self._username, self._hostname)
+        with self._master.lock():
+            if not self._master.alive():
+                self._start_master()
+
+    def _close_mux(self):
+        if self._master is not None:
+            release_master(self._master)
+            self._master = None
+
+    @contextmanager
+    def _session(self):
+        # Sessions past the server's limit would be refused, so they queue here instead
+        with self._master.sessions():
+            with self._master.lock():
+                if not self._master.alive():
+                    self.warning("ssh control master for %s is gone; restarting",
+                                 self._master.destination())
+                    self._start_master()
+            yield
+
+    def _start_master(self):
+        Path(CONTROL_DIR).mkdir(parents=True, exist_ok=True)
+        self.debug("Starting ssh control master for %s at %s",
+                   self._destination, self._mux_options["ControlPath"])
+        args = ["ssh", "-M", "-N", "-f", *self._ssh_prelude, self._destination]
+        # The backgrounded master keeps the inherited descriptors open, so its output is
+        # discarded rather than piped (reading a pipe would block until the master exits)
+        try:
+            with _HANDSHAKE_GATE:
+                result = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL, timeout=60)
+        except subprocess.TimeoutExpired:
+            self.warning("Timed out starting ssh control master")
+            return
+        if result.returncode != 0:
+            # Not fatal: with ControlMaster=auto the first connection becomes the master
+            self.warning("Could not start ssh control master (exit code %d)", result.returncode)
+
+    def upload(self, files, retry_count=1):
+        # All (local, remote) pairs go up in one sftp session
+        batch = [f"put {sftp_quote(local_src)} {sftp_quote(remote_path)}"
+                 for (local_src, remote_path) in files]
+        transfer_text = f"{', '.join(repr(local_src) for (local_src, _) in files)} to"
+        return self.run_sftp(batch, transfer_text, retry_count=retry_count)
+
+    def run_sftp(self, batch, transfer_text, retry_count=1):
+        args = [*self._sftp_prelude, '-b', '-', self._destination]
         self.debug(
-            "Transferring file %s %s with options %s; -i %s; retry_delay=%f, retry_count=%d",
-            transfer_text, hoststring, json.dumps(prelude), cert_path, retry_delay, retry_count)
+            "Transferring %s %s with batch %s; options %s; retry_delay=%f, retry_count=%d",
+            transfer_text, self._destination, batch, Lazy(json.dumps, self._sftp_prelude),
+            self._retry_delay, retry_count)
 
         task_messages = (f"transfer {transfer_text} host {self._hostname}",
                          f"transfer {transfer_text} remote")
-        for current in retry(retry_count, task=task_messages, logger=self.logger):  # pylint: disable=unexpected-keyword-arg
-            child = pexpect.spawn(command="scp", args=args)
-            child.expect(pexpect.EOF)
-            child.close()
-
-            if child.exitstatus == 0:
+        for current in retry(retry_count, task=task_messages, logger=self.logger,  # pylint: disable=unexpected-keyword-arg
+                             **SSH_BACKOFF):
+            # Batch mode aborts (with a non-zero exit code) on the first failed command
+            with self._session():
+                result = subprocess.run(["sftp", *args], input="\n".join(batch).encode(),
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+            if result.returncode == 0:
                 # Successful
                 return True
             else:
-                current.failed(f"exit code ({child.exitstatus})")
+                current.failed(f"exit code ({result.returncode}): "
+                               f"{result.stderr.decode(errors='replace').strip()}")
+
+    def fetch(self, remote_path, local_dest, retry_count=1):
+        remote_shell = shlex.join(["ssh", *self._ssh_prelude])
+        # No compression: the results are already gzipped. --partial keeps an interrupted
+        # download around so the next attempt resumes it
+        args = ["rsync", "--partial", "--inplace", "-e", remote_shell,
+                f"{self._destination}:{remote_path}", local_dest]
+        self.debug("Fetching remote:%s to '%s' with %s; retry_count=%d",
+                   remote_path, local_dest, Lazy(json.dumps, args), retry_count)
+
+        task_messages = (f"fetch '{local_dest}' from host {self._hostname}",
+                         f"fetch '{local_dest}' from remote")
+        for current in retry(retry_count, task=task_messages, logger=self.logger,  # pylint: disable=unexpected-keyword-arg
+                             **SSH_BACKOFF):
+            with self._session():
+                result = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE)
+            if result.returncode == 0:
+                return True
+            current.failed(f"exit code ({result.returncode}): "
+                           f"{result.stderr.decode(errors='replace').strip()}")
 
     def terminal(self, retry_count=1):
-        cert_path = self._config.get("ssh_cert", "id_rsa")
-        username = self._config.get("username", "root")
         server = self._hostname
         options = dict(StrictHostKeyChecking="no",
-                       UserKnownHostsFile="/dev/null")
+                       UserKnownHostsFile="/dev/null",
+                       **self._mux_options)
         ssh = pxssh.pxssh(options=options)
-        options_text = f"-i {cert_path}; retry_count={retry_count}"
+        options_text = f"-i {self._cert_path}; retry_count={retry_count}"
         self.debug("SSHing into %s@%s with options %s; %s",
-                   username, server, json.dumps(options), options_text)
+                   self._username, server, Lazy(json.dumps, options), options_text)
 
         # Capture failed exceptions to close resources
         try:
             task_messages = (f"attach ssh terminal to host {self._hostname}",
                              f"attach ssh terminal to remote")
-            for current in retry(retry_count, task=task_messages, logger=self.logger):  # pylint: disable=unexpected-keyword-arg
+            for current in retry(retry_count, task=task_messages, logger=self.logger,  # pylint: disable=unexpected-keyword-arg
+                                 **SSH_BACKOFF):
                 try:
-                    ssh.login(server, username=username, ssh_key=cert_path)
+                    # Without a live control master this is a full handshake
+                    with _HANDSHAKE_GATE:
+                        ssh.login(server, username=self._username, ssh_key=self._cert_path)
                 except pxssh.ExceptionPxssh as ex:
                     current.failed(ex)
                 else:
@@ -136,36 +338,63 @@ class TestExecutionThread(threading.Thread):
             ssh.close()
             raise
 
-    def run_sequence(self, ssh, sequence, retry_count=1, timeout=30):
+    def wait_prompt(self, ssh, timeout):
+        if ssh.prompt(timeout=timeout):
+            return True, ssh.before.decode(errors="replace")
+        output = ssh.before.decode(errors="replace")
+        # Interrupt the command once so the shell is back at a prompt for the retry
+        ssh.sendcontrol('c')
+        ssh.prompt(timeout=10)
+        return False, output
+
+    def run_command(self, ssh, command, timeout):
+        # The exit code is printed behind a unique marker on the same line, so a single prompt
+        # wait covers both (the terminal's echo of the line shows the unexpanded format)
+        marker = f"__EC_{uuid.uuid4().hex}_"
+        ssh.sendline(f"{command}; printf '\\n{marker}%d\\n' $?")
+        completed, output = self.wait_prompt(ssh, timeout)
+        if not completed:
+            return None, output
+        match_obj = re.search(rf"{marker}(\d+)", output)
+        if match_obj is None:
+            self.warning("Couldn't find the exit code of command %s", command)
+            return 1, output
+        return int(match_obj.group(1)), output
+
+    def run_script(self, working_dir, script_path):
+        args = ["ssh", *self._ssh_prelude, self._destination,
+                f"cd {working_dir} && {script_path}"]
+        # A non-interactive session over the control master: reading the pipe blocks until
+        # output arrives and the exit status comes back with the process
+        with self._session(), subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                               stdout=subprocess.PIPE,
+                                               stderr=subprocess.STDOUT) as process:
+            for line in process.stdout:
+                self.debug("%s", line.decode(errors="replace").rstrip())
+        return process.returncode
+
+    def run_sequence(self, ssh, sequence, retry_count=1, timeout=30, batch=True):
         self.debug("Executing sequence %s with options retry_count=%d", sequence, retry_count)
 
+        # Joined with && the whole sequence runs behind a single prompt while still stopping
+        # at the first failing command; unbatched, each command reports its own exit code
+        commands = [" && ".join(sequence)] if batch else sequence
+
         # Capture failed exceptions to close resources
         try:
             task_messages = (f"execute command sequence to host {self._hostname}",
                              f"execute command sequence to remote")
-            for current in retry(retry_count, task=task_messages, logger=self.logger):  # pylint: disable=unexpected-keyword-arg
+            for current in retry(retry_count, task=task_messages, logger=self.logger,  # pylint: disable=unexpected-keyword-arg
+                                 **SSH_BACKOFF):
                 failed = False
-                for command in sequence:
-                    ssh.sendline(command)
-                    output = ""
-                    while not ssh.prompt(timeout=timeout):
-                        output += ssh.before.decode()
-                        ssh.sendcontrol('c')
-                    output += ssh.before.decode()
-
-                    ssh.sendline("echo $?")
-                    ssh.prompt(timeout=10)
-
-                    result = ssh.before.decode().strip().splitlines()
-                    if len(result) > 0:
-                        try:
-                            exitcode = int(result[-1])
-                        except TypeError:
-                            self.warning("Couldn't decode exit code from command %s: %s",
-                                         command, result)
-                            exitcode = 1
+                for command in commands:
+                    exitcode, output = self.run_command(ssh, command, timeout)
                     self.debug("[%s] %s", str(exitcode), output)
 
+                    if exitcode is None:
+                        current.failed(f"prompt timeout after {timeout}s: {command}")
+                        failed = True
+                        break
                     # If exit code is non-zero, assume failed
                     if exitcode != 0:
                         current.failed(f"command: {command}")
@@ -184,6 +413,7 @@ class TestExecutionThread(threading.Thread):
     def run(self):
         try:
             self.info("Starting execution thread (%s)", self._hostname, external=True)
+            self._open_mux()
             self.info("Beginning setup")
             self.setup()
             self.info("Finishing setup")
@@ -198,75 +428,60 @@ class TestExecutionThread(threading.Thread):
             self.warning("Exiting test early")
         except OperationFailed:
             self.error("Failed test; exiting")
+        finally:
+            self._close_mux()
 
     def setup(self):
-        # Transfer SSH certificate
-        cert_path = self._config.get("ssh_cert", "id_rsa")
-        self.info("Transfering the SSH certificate from %s to remote:.ssh/id_rsa", cert_path)
-        self.transfer(local_src=cert_path, remote_path=".ssh/id_rsa", retry_count=10)
-
-        # Transfer rendered config file
+        # Transfer SSH certificate and rendered config file together
         remote_config = self._config.get("remote_config", "config.sh")
+        self.info("Transfering the SSH certificate from %s to remote:.ssh/id_rsa", self._cert_path)
         self.info("Transfering rendered config file from %s to remote:%s",
                   self._config_path, remote_config)
-        self.transfer(local_src=self._config_path, remote_path=remote_config, retry_count=10)
+        self.upload([(self._cert_path, ".ssh/id_rsa"), (self._config_path, remote_config)],
+                    retry_count=10)
 
     def execute(self):
-        for current in retry(retry_count=5, task=f'executing experiment {self._test.id()}', logger=self.logger):
+        for current in retry(retry_count=5, task=f'executing experiment {self._test.id()}',
+                             logger=self.logger, **SSH_BACKOFF):  # pylint: disable=unexpected-keyword-arg
             try:
-                # Attach a remote terminal to the executor host
-                self.info("Attaching a remote terminal to the executor host")
-                ssh = self.terminal(retry_count=10)
-
-                # Clone the repo
-                repo = self._config.get("repo")
-                remote_folder = "repo"
-                self.info("Cloning the repo %s into remote:%s", repo, remote_folder)
-
-                # Build the git command with optional branch support
-                git_command = ["git", "clone"]
-                branch = self._config.get("branch", None)
-                if branch:
-                    git_command.extend(["--single-branch", "--branch", f'"{branch}"'])
-                git_command.extend([f'"{repo}"', remote_folder])
-
-                clone_sequence = [f'sudo rm -rf {remote_folder}',
-                                  ' '.join(git_command)]
-                self.run_sequence(ssh, sequence=clone_sequence, retry_count=10, timeout=120)
-
-                # Copy the config file into place
-                experiments_path = self._config.get("experiments_path", "experiments")
-                self._remote_experiment_path = path.join(
-                    remote_folder,
-                    experiments_path,
-                    self._test.experiment())
-                remote_config = self._config.get("remote_config", "config.sh")
-                dest_config_path = path.join(
-                    self._remote_experiment_path,
-                    "conf",
-                    remote_config)
-                self.debug("Copy the config file from remote:%s into place at remote:%s",
-                           remote_config, dest_config_path)
-                self.run_sequence(
-                    ssh, sequence=[f'cp {remote_config} {dest_config_path}'], retry_count=10)
-
-                # Change the working directory to the experiment root (eventual destination of results)
-                self.debug("Change the working directory to remote:%s",
-                           self._remote_experiment_path)
-                self.run_sequence(
-                    ssh, sequence=[f'cd {self._remote_experiment_path}'], retry_count=1)
-
-                # Run the primary script
+                with self._session():
+                    # Attach a remote terminal to the executor host
+                    self.info("Attaching a remote terminal to the executor host")
+                    ssh = self.terminal(retry_count=10)
+
+                    # Clone the repo
+                    repo = self._config.get("repo")
+                    remote_folder = REMOTE_FOLDER
+                    self.info("Cloning the repo %s into remote:%s", repo, remote_folder)
+
+                    # Build the git command with optional branch support
+                    git_command = ["git", "clone"]
+                    branch = self._config.get("branch", None)
+                    if branch:
+                        git_command.extend(["--single-branch", "--branch", f'"{branch}"'])
+                    git_command.extend([f'"{repo}"', remote_folder])
+
+                    clone_sequence = [f'sudo rm -rf {remote_folder}',
+                                      ' '.join(git_command)]
+                    self.run_sequence(ssh, sequence=clone_sequence, retry_count=10, timeout=120)
+
+                    # Copy the config file into place
+                    remote_config = self._config.get("remote_config", "config.sh")
+                    dest_config_path = rjoin(self._remote_experiment_path, "conf", remote_config)
+                    self.debug("Copy the config file from remote:%s into place at remote:%s",
+                               remote_config, dest_config_path)
+                    self.run_sequence(
+                        ssh, sequence=[f'cp {remote_config} {dest_config_path}'], retry_count=10)
+
+                    ssh.logout()
+
+                # Run the primary script from the experiment root (eventual destination of results)
                 script_path = './scripts/run.sh'
                 self.info("Running primary script at remote:%s", script_path)
-                ssh.sendline(script_path)
-                while not ssh.prompt(timeout=60):
-                    self.debug("\n%s", ssh.before.decode().strip())
-                    if ssh.before:
-                        ssh.expect(r'.+')
-                self.debug("\n%s", ssh.before.decode().strip())
+                exitcode = self.run_script(self._remote_experiment_path, script_path)
+                if exitcode != 0:
+                    self.warning("Primary script exited with code %d", exitcode)
                 self.info("Finished primary script")
-                ssh.logout()
                 return
             except ExitEarly:
                 raise
@@ -275,31 +490,34 @@ class TestExecutionThread(threading.Thread):
 
     def teardown(self):
         # Move the results tar to /results/{id}.tar.gz
-        results_path = path.join(self._remote_experiment_path, "results.tar.gz")
+        results_path = rjoin(self._remote_experiment_path, "results.tar.gz")
         self.debug("Moving the results tar from remote:%s to %s", results_path, self._results_path)
-        self.transfer(remote_path=results_path, local_dest=self._results_path, retry_count=5)
+        self.fetch(results_path, self._results_path, retry_count=5)
 
-        # Check for stopping before attempting to acquire mutex (might be poisoned)
-        if stopping:
+        # Leave the experiment alone when stopping
+        if stopping():
             return
 
-        # Terminate the experiment on cloudlab
-        with self._cloudlab_lock:
-            try:
-                old_logger = self._cloudlab_driver.logger
-                self._cloudlab_driver.set_logger(self.logger)
-                self._cloudlab_driver.terminate(self._experiment)
-            except OperationFailed as ex:
-                self.error("Could not terminate experiment on cloudlab:")
-                self.error(ex)
-            except Exception as ex:
-                self.error("Encountered error while terminating experiment on cloudlab driver:")
-                self.error(ex)
-            finally:
-                self._cloudlab_driver.set_logger(old_logger)
-
-        # Sleep for 5 minutes between teardown and provisioning
-        backoff_dur = 5
-        self.info("Sleeping for %d minutes after finished experiment", backoff_dur)
-        if wait(backoff_dur * 60):
-            raise ExitEarly()
+        # Terminate the experiment on cloudlab, queued behind other tests' terminations;
+        # it doesn't need the test's slot, so the outcome is only logged once it finishes
+        try:
+            termination = self._cloudlab_driver.submit_terminate(self._experiment,
+                                                                 logger=self.logger)
+        except Exception as ex:
+            self.error("Could not queue experiment termination on cloudlab driver:")
+            self.error(ex)
+            return
+        # Log in this test's context, whichever thread completes the termination
+        termination.add_done_callback(
+            functools.partial(contextvars.copy_context().run, self.terminated))
+
+    def terminated(self, termination):
+        try:
+            termination.result()
+        except OperationFailed as ex:
+            self.error("Could not terminate experiment on cloudlab:")
+            self.error(ex)
+        except Exception as ex:
+            self.error("Encountered error while terminating experiment on cloudlab driver:")
+            self.error(ex)
+
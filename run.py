@@ -5,32 +5,42 @@ Automation script for running cloudlab experiments
 """
 
 import re
-import sys
 import os
-import copy
+import sys
+import json
+import pickle
+import tempfile
 import traceback
 import getpass
-import signal
+import logging
 import threading
+import glob
+import functools
+import itertools
+import signal
 from os import path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 from typing import *
 import click
 import yaml
-from deepmerge import always_merger
 from execution.retry import retry
-from execution.cloudlab import Cloudlab
-from execution.log import log, setup_logger
+from execution.cloudlab import Cloudlab, quit_pooled_drivers
+from execution.log import log, current_test
 from execution.control import stop, stopping
-from execution.test import TestExecutionThread, TestReplica
+from execution.test import TestExecution, TestReplica
 from execution.exceptions import OperationFailed, ExitEarly
 
 
+# libyaml-backed loader when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 HOST_CONFIG_REGEX = re.compile(r'(?m)^((?:readonly )?[A-Z_]+_HOSTS?)="?.*"?$')
-RESULT_TAR_REGEX = re.compile(r'(?:^|.*/{1,2})(.+)-(\d+)\.tar\.gz$')
-thread_queue = []  # pylint: disable=invalid-name
+PASSWORD_KEYS = ("password_path",)
+REQUIRED_TEST_KEYS = ("id", "experiment")
+test_pool = None  # pylint: disable=invalid-name
+running_tests = set()  # pylint: disable=invalid-name
 cloudlab = None  # pylint: disable=invalid-name
-cloudlab_lock = threading.Lock()  # pylint: disable=invalid-name
+# Provisioning happens in the order tests asked for it
 
 
 @click.command()
@@ -89,7 +99,12 @@ def run(config: Dict[str, Any], repo_path: str) -> None:
         log.error("Experiment directory %s not found", experiments_dir)
         return
 
-    tests = flatten_tests(config)
+    # Test sets are flattened lazily, but malformed ones are caught here, before logging in
+    try:
+        tests = flatten_tests(config)
+    except KeyError as ex:
+        log.error("Invalid test set: %s", ex.args[0])
+        return
 
     # Initialize cloudlab driver
     username = config.get("username")
@@ -98,8 +113,8 @@ def run(config: Dict[str, Any], repo_path: str) -> None:
         return
 
     # Load Cloudlab password
-    if 'password_path' in config:
-        password_path = config['password_path']
+    password_path = find(config, PASSWORD_KEYS)
+    if password_path is not None:
         try:
             with open(password_path, 'r') as password_file:
                 password = password_file.read().strip()
@@ -118,92 +133,99 @@ def run(config: Dict[str, Any], repo_path: str) -> None:
     cloudlab = Cloudlab(username, password, headless)
 
     # Attempt to log in
-    with cloudlab_lock:
-        try:
-            log.info("Logging into cloudlab")
-            cloudlab.login()
-        except ExitEarly:
-            return
-        except OperationFailed as ex:
-            log.error("Could not log into cloudlab:")
-            log.error(ex)
-            log.error(traceback.format_exc())
-            return
-        except Exception as ex:
-            log.error("Encountered error while logging into cloudlab driver:")
-            log.error(ex)
-            log.error(traceback.format_exc())
-            return
-        else:
-            log.info("Cloudlab login successful")
+    try:
+        log.info("Logging into cloudlab")
+        cloudlab.login()
+    except ExitEarly:
+        return
+    except OperationFailed as ex:
+        log.error("Could not log into cloudlab:")
+        log.error(ex)
+        log.error(traceback.format_exc())
+        return
+    except Exception as ex:
+        log.error("Encountered error while logging into cloudlab driver:")
+        log.error(ex)
+        log.error(traceback.format_exc())
+        return
+    else:
+        log.info("Cloudlab login successful")
 
     max_concurrency = config.get("max_concurrency", 1)
+    global test_pool, running_tests  # pylint: disable=global-statement, invalid-name
+    test_pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="test")
 
     for test in tests:
-        test_logger = setup_logger(name=test.id(), inner=log, prefix=f"[{test.id()}] ")
-        try:
-            for current in retry(task=f"executing test {test.id()}", retry_count=5, logger=test_logger):  # pylint: disable=unexpected-keyword-arg
-                # Make sure there aren't more than `max_concurrency` tests executing
-                while len(thread_queue) >= max_concurrency:
-                    thread_queue[0].join()
-                    thread_queue.pop(0)
-
-                if conduct_test(test, current, config, experiments_dir, logger=test_logger):
-                    # Move to next test if function returns True
-                    break
-        except ExitEarly:
+        # Make sure there aren't more than `max_concurrency` tests provisioning or executing,
+        # waiting on whichever finishes first
+        if len(running_tests) >= max_concurrency:
+            _, running_tests = wait(running_tests, return_when=FIRST_COMPLETED)
+        # Quitting stops and then shuts the pool down from another thread, possibly while
+        # waiting above
+        if stopping():
             return
-        except Exception as ex:
-            test_logger.error("failed to conduct test")
-            test_logger.error(ex)
-            test_logger.error(traceback.format_exc())
+        try:
+            running_tests.add(test_pool.submit(run_test, test, config, experiments_dir))
+        except RuntimeError:
+            if stopping():
+                return
+            raise
+
+    join_all()
+
+
+def run_test(test, config, experiments_dir):
+    # Everything logged from here (and from tasks that copy this context) gets the test's prefix
+    token = current_test.set(test.id())
+    try:
+        for current in retry(task=f"executing test {test.id()}", retry_count=5, logger=log):  # pylint: disable=unexpected-keyword-arg
+            if conduct_test(test, current, config, experiments_dir, logger=log):
+                # Move to next test if function returns True
+                break
+    except ExitEarly:
+        return
+    except Exception as ex:
+        log.error("failed to conduct test")
+        log.error(ex)
+        log.error(traceback.format_exc())
+    finally:
+        current_test.reset(token)
 
 
 def conduct_test(test, current, config, experiments_dir, logger):
     logger.info("Starting test %s", test.id())
     logger.debug(test)
 
-    test_experiment_dir = path.join(experiments_dir, test.experiment())
-    if not path.exists(test_experiment_dir):
-        logger.error("Test experiment directory %s not found", test_experiment_dir)
-        return True
-
-    config_sh_path = path.join(test_experiment_dir, "conf/config.sh")
-    if not path.exists(config_sh_path):
-        logger.error("Test experiment config file %s not found", config_sh_path)
+    # Load test config (a missing experiment directory shows up as a missing file)
+    config_sh_path = path.join(experiments_dir, test.experiment(), "conf/config.sh")
+    try:
+        test_config = read_config_sh(config_sh_path, os.stat(config_sh_path).st_mtime_ns)
+    except FileNotFoundError as ex:
+        logger.error("Test experiment config file %s not found: %s", config_sh_path, ex)
         return True
 
-    # Load test config
-    test_config = ""
-    with open(config_sh_path, "r") as config_file:
-        test_config = config_file.read()
-
     # Provision experiment from cloudlab
-    # Check for stopping before attempting to acquire mutex (might be poisoned)
-    if stopping:
+    if stopping():
         raise ExitEarly()
-    with cloudlab_lock:
-        try:
-            logger.info("Provisioning new experiment from cloudlab")
-            old_logger = cloudlab.logger
-            cloudlab.set_logger(logger)
-            experiment = cloudlab.provision(profile=test.profile(), name=test.id())
-        except ExitEarly:
-            raise
-        except OperationFailed as ex:
-            logger.error("Could not provision experiment on cloudlab")
-            current.failed(ex)
-            return False
-        except Exception as ex:
-            logger.error("Encountered error while logging into cloudlab driver:")
-            current.failed(ex)
-            return False
-        else:
-            hostnames = "\n".join([f"│ {host}" for host in experiment.hostnames()])
-            logger.info("Successfully provisioned new experiment from cloudlab: %s\n%s",
-                        experiment, hostnames)
-        finally:
-            cloudlab.set_logger(old_logger)
+    # Each worker thread provisions through its own browser session, so nothing is serialized
+    provisioner = cloudlab.session(logger)
+    try:
+        logger.info("Provisioning new experiment from cloudlab")
+        experiment = provisioner.provision(profile=test.profile(), name=test.id())
+    except ExitEarly:
+        raise
+    except OperationFailed as ex:
+        logger.error("Could not provision experiment on cloudlab")
+        current.failed(ex)
+        return False
+    except Exception as ex:
+        logger.error("Encountered error while logging into cloudlab driver:")
+        current.failed(ex)
+        return False
+    else:
+        hostnames = "\n".join([f"│ {host}" for host in experiment.hostnames()])
+        logger.info("Successfully provisioned new experiment from cloudlab: %s\n%s",
+                    experiment, hostnames)
 
     # Get hosts and then assign
     hosts = experiment.hostnames()
@@ -211,20 +233,26 @@ def conduct_test(test, current, config, experiments_dir, logger):
     experiment_hosts = hosts[1:]
     hostname_options = assign_hosts(test_config, experiment_hosts)
 
-    def replace_value(value):
-        def replace_inner(match):
-            if isinstance(value, str):
-                val = f'"{value}"'
-            else:
-                val = str(value)
-            return f'{match.group(1)}={val}'
-        return replace_inner
+    def replace_value(match):
+        value = options[match.group(2)]
+        if isinstance(value, str):
+            val = f'"{value}"'
+        else:
+            val = str(value)
+        return f'{match.group(1)}={val}'
 
-    # Then, replace overrides
+    # Then, replace overrides in a single pass, splicing the replacements between the
+    # untouched slices of the file
     options = {**test.options(), **hostname_options}
-    for (key, value) in options.items():
-        key_regex = re.compile(f'(?m)^((?:readonly )?{key})="?.*"?$')
-        test_config = re.sub(key_regex, replace_value(value), test_config)
+    if options:
+        parts = []
+        last = 0
+        for match in option_regex(frozenset(options)).finditer(test_config):
+            parts.append(test_config[last:match.start()])
+            parts.append(replace_value(match))
+            last = match.end()
+        parts.append(test_config[last:])
+        test_config = "".join(parts)
 
     # Create working directory
     work_dir = path.join("working", test.id())
@@ -233,28 +261,62 @@ def conduct_test(test, current, config, experiments_dir, logger):
 
     config_sh_path = path.join(work_dir, "config.sh")
     try:
-        with open(config_sh_path, "w") as rendered_config_file:
-            rendered_config_file.write(test_config)
+        write_atomically(config_sh_path, test_config.encode())
         logger.info("Wrote rendered config file to %s", config_sh_path)
     except IOError as ex:
         logger.error("Could not write rendered config to %s", config_sh_path)
         current.failed(ex)
         return False
 
-    # Spawn thread to handle ssh/scp yielding
+    # Execute on this worker thread
     log_path = path.join("logs", test.id() + ".log")
     results_path = path.join("results", test.id() + ".tar.gz")
     # pylint: disable=unexpected-keyword-arg
-    test_thread = TestExecutionThread(test=test, hostname=executor_host,
-                                      config_path=config_sh_path, log_path=log_path,
-                                      results_path=results_path, config=config,
-                                      experiment=experiment, cloudlab=cloudlab,
-                                      cloudlab_lock=cloudlab_lock, logger=logger)
-    test_thread.start()
-    thread_queue.append(test_thread)
+    execution = TestExecution(test=test, hostname=executor_host,
+                              config_path=config_sh_path, log_path=log_path,
+                              results_path=results_path, config=config,
+                              experiment=experiment, cloudlab=cloudlab, logger=logger)
+    execution.run()
     return True
 
 
+def write_atomically(file_path, data):
+    """
+    Writes the file through a temporary file renamed over it, so an interrupted write never
+    leaves a partial file behind
+    """
+
+    temp_path = f"{file_path}.tmp"
+    handle = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(handle, view):]
+    finally:
+        os.close(handle)
+    os.replace(temp_path, file_path)
+
+
+@functools.lru_cache(maxsize=128)
+def read_config_sh(config_sh_path, _mtime_ns):
+    """
+    Reads an experiment's config.sh, cached until the file is modified
+    """
+
+    with open(config_sh_path, "r") as config_file:
+        return config_file.read()
+
+
+@functools.lru_cache(maxsize=None)
+def option_regex(keys):
+    """
+    Matches the assignment of any of the given keys in a config.sh file
+    """
+
+    alternation = "|".join(re.escape(key) for key in sorted(keys))
+    return re.compile(f'(?m)^((?:readonly )?({alternation}))="?.*"?$')
+
+
 def assign_hosts(config_sh, hosts):
     assignments = {}
     host_fields = [match.group(1) for match in re.finditer(HOST_CONFIG_REGEX, config_sh)]
@@ -274,87 +336,141 @@ def assign_hosts(config_sh, hosts):
     return {key: " ".join(value) for (key, value) in assignments.items()}
 
 
-def flatten_tests(config: Dict[str, Any]) -> List[TestReplica]:
+def flatten_tests(config: Dict[str, Any]) -> Iterator[TestReplica]:
     """
-    Flattens test replicas into a single list of TestReplicas
+    Lazily flattens test replicas into a stream of TestReplicas
     """
 
     tests = config.get("tests", [])
     global_options = config.get("options", {})
+    id_length = replica_id_length(tests)
     flattened = flatten_globals(tests, global_options)
     flattened = flatten_matrices(flattened)
-    flattened = flatten_replicas(flattened)
-    return flattened
+    return flatten_replicas(flattened, id_length)
 
 
-def flatten_globals(tests: List[Dict[str, Any]],
-                    global_options: Dict[str, Any]) -> List[Dict[str, Any]]:
-    flattened = []
+def flatten_globals(tests: Iterable[Dict[str, Any]],
+                    global_options: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
     for test_set in tests:
         options = {**test_set.get("options", {}), **global_options}
         test_set_new = test_set.copy()
         test_set_new["options"] = options
-        flattened.append(test_set_new)
-    return flattened
+        yield test_set_new
+
+
+def matrix_combinations(test_set: Dict[str, Any]) -> Optional[Iterator[Tuple[Any, ...]]]:
+    """
+    Gets every choice of one (dimension name, value) pair per matrix dimension, in dimension
+    order, or None if the test set has nothing to expand
+    """
 
+    if "matrix" not in test_set:
+        return None
 
-def flatten_matrices(tests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    flattened = []
+    # Dimensions without values are skipped, as are values without an id
+    dimensions = [[(dimension.get("name", "unknown"), value) for value in values
+                   if value.get("id", None)]
+                  for dimension in test_set["matrix"]
+                  for values in [dimension.get("values", [])] if values]
+    if not dimensions:
+        return None
+    if not test_set.get("id", None):
+        return iter(())
+
+    # Reversed so that the first dimension varies fastest
+    return (combination[::-1] for combination in itertools.product(*reversed(dimensions)))
+
+
+def flatten_matrices(tests: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
     for test_set in tests:
-        if "matrix" in test_set:
-            # Perform matrix config expansion
-            intermediate = [test_set]
-            dimensions = test_set["matrix"]
-            for dimension in dimensions:
-                name = dimension.get("name", "unknown")
-                values = dimension.get("values", [])
-                if not values:
-                    continue
-
-                new_intermediate = []
-                # Expand the current working set
-                for partial_config in values:
-                    for test in intermediate:
-                        test_id = test.get('id', None)
-                        if not test_id:
-                            break
-
-                        value_id = partial_config.get('id', None)
-                        if not value_id:
-                            continue
-
-                        new_id = f"{test_id}-{value_id}"
-                        new_test = copy.deepcopy(test)
-                        always_merger.merge(new_test, partial_config)
-
-                        # Overwite ID
-                        new_test["id"] = new_id
-
-                        # Merge in matrix choice id
-                        if "matrix_ids" not in new_test:
-                            new_test["matrix_ids"] = {}
-                        partial_matrix_ids = {}
-                        partial_matrix_ids[name] = value_id
-                        always_merger.merge(new_test["matrix_ids"], partial_matrix_ids)
-
-                        new_intermediate.append(new_test)
-                intermediate = new_intermediate
-            flattened.extend(intermediate)
-        else:
-            flattened.append(test_set)
-    return flattened
+        combinations = matrix_combinations(test_set)
+        if combinations is None:
+            yield test_set
+            continue
+
+        # Perform matrix config expansion, building each combination once
+        for combination in combinations:
+            new_test = clone(test_set)
+            value_ids = []
+            for (name, partial_config) in combination:
+                merge(new_test, partial_config)
+                value_id = partial_config["id"]
+                value_ids.append(str(value_id))
+
+                # Merge in matrix choice id
+                if "matrix_ids" not in new_test:
+                    new_test["matrix_ids"] = {}
+                merge(new_test["matrix_ids"], {name: value_id})
+
+            # Overwite ID
+            new_test["id"] = "-".join([str(test_set["id"]), *value_ids])
+            yield new_test
+
+
+def replica_id_length(tests: Iterable[Dict[str, Any]]) -> int:
+    """
+    Gets the number of digits in replica ids: enough for the largest replica count of any
+    expanded test, computed from the matrix choices without expanding them. Also checks
+    that every expanded test has the required keys, raising a KeyError otherwise
+    """
 
+    def replica_counts():
+        for test_set in tests:
+            replicas = test_set.get("replicas", 1)
+            combinations = matrix_combinations(test_set)
+            if combinations is None:
+                check_required_keys(test_set)
+                yield replicas
+                continue
+            # The last chosen value that sets replicas wins, as when merging
+            for combination in combinations:
+                check_required_keys(test_set, combination)
+                yield functools.reduce(
+                    lambda count, choice: choice[1].get("replicas", count), combination, replicas)
 
-def flatten_replicas(tests: List[Dict[str, Any]]) -> List[TestReplica]:
-    replicas_len = (len(str(test_set.get("replicas", 1))) for test_set in tests)
     # Use minimum id number of 2
-    id_length = max(max(replicas_len), 2)
-    test_id_fmt = f"{{}}-{{:0{id_length}}}"
+    return max(max((len(str(count)) for count in replica_counts()), default=0), 2)
+
+
+def check_required_keys(test_set: Dict[str, Any], combination: Tuple[Any, ...] = ()) -> None:
+    for key in REQUIRED_TEST_KEYS:
+        if key not in test_set and not any(key in value for (_, value) in combination):
+            raise KeyError(f"test set {test_set.get('id', '(no id)')} has no {key}")
+
+
+def clone(value):
+    """
+    Copies the dicts and lists of a parsed config tree, sharing its (immutable) leaves
+    """
+
+    if isinstance(value, dict):
+        return {key: clone(inner) for (key, inner) in value.items()}
+    if isinstance(value, list):
+        return [clone(inner) for inner in value]
+    return value
+
+
+def merge(destination, source):
+    """
+    Deep merges source into destination in place with the semantics of deepmerge's
+    always_merger: dicts merge, lists append and anything else overwrites. Values taken
+    from source are cloned so later merges never write into it
+    """
+
+    for (key, value) in source.items():
+        current = destination.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            merge(current, value)
+        elif isinstance(value, list) and isinstance(current, list):
+            destination[key] = current + clone(value)
+        else:
+            destination[key] = clone(value)
+    return destination
 
-    # Get list of completed tests to skip
-    completed_tests = get_completed_tests("results")
 
-    flattened = []
+def flatten_replicas(tests: Iterable[Dict[str, Any]], id_length: int) -> Iterator[TestReplica]:
+    test_id_fmt = f"{{}}-{{:0{id_length}}}"
+
     for test_set in tests:
         test_id = test_set["id"]
         experiment = test_set["experiment"]
@@ -366,51 +482,35 @@ def flatten_replicas(tests: List[Dict[str, Any]]) -> List[TestReplica]:
         # Extract all additional values as the config
         config = {k:v for k,v in test_set.items() if k not in [
             "id", "experiment", "replicas", "completed", "profile", "options", "matrix_ids"]}
+        # Only look for results when there are replicas left to run, then skip those that
+        # have been completed
+        needed = range(completed, replicas)
+        if needed:
+            needed = sorted(frozenset(needed) - get_completed_replicas(test_id))
 
-        for i in range(replicas - completed):
-            j = i + completed
-            # Make sure test hasn't been completed
-            if test_id in completed_tests and j in completed_tests[test_id]:
-                continue
-
+        for j in needed:
             test_run_id = test_id_fmt.format(test_id, j)
-            flattened.append(TestReplica(test_id=test_run_id, options=options,
-                                         experiment=experiment, profile=profile,
-                                         matrix_ids=matrix_ids, config=config))
-    return flattened
+            yield TestReplica(test_id=test_run_id, options=options,
+                              experiment=experiment, profile=profile,
+                              matrix_ids=matrix_ids, config=config)
 
 
-def get_completed_tests(results_dir):
-    completed_tests = {}
-    try:
-        files = find_files(results_dir, ".tar.gz")
-        for f in files:
-            filename = os.path.basename(f)
-            match_obj = re.search(RESULT_TAR_REGEX, filename)
-            if match_obj:
-                test_id = match_obj.group(1)
-                test_replica = int(match_obj.group(2))
-                if test_id not in completed_tests:
-                    completed_tests[test_id] = set()
-                completed_tests[test_id].add(test_replica)
-    except OSError:
-        log.warning(
-            "Could not detect completed experiments. Falling back to 'completed' value in test configs")
-    return completed_tests
-
-
-def find_files(path: str, extension: str) -> List[str]:
+@functools.lru_cache(maxsize=None)
+def get_completed_replicas(test_id: str, results_dir: str = "results") -> FrozenSet[int]:
     """
-    Gets a list of every file in the given path that has the given file extension
+    Gets the replicas of the given test that already have a results archive
     """
 
-    file_list = []
-    for root, _, files in os.walk(path):
-        for file in files:
-            if file.endswith(extension):
-                file_list.append(os.path.join(root, file))
-
-    return file_list
+    # Result archives are named <test id>-<replica>.tar.gz; the replica check also rules out
+    # tests whose id merely starts with this one
+    prefix = f"{test_id}-"
+    pattern = path.join(glob.escape(results_dir), f"{glob.escape(prefix)}*.tar.gz")
+    completed = set()
+    for result_path in glob.iglob(pattern):
+        test_replica = path.basename(result_path)[len(prefix):-len(".tar.gz")]
+        if test_replica.isdecimal():
+            completed.add(int(test_replica))
+    return frozenset(completed)
 
 
 def load_config(config_path: str) -> Dict[str, Any]:
@@ -420,31 +520,77 @@ def load_config(config_path: str) -> Dict[str, Any]:
 
     config_dict = None
     try:
-        with open(config_path, "r") as config_file:
-            loader = yaml.Loader(config_file)
-            config_dict = loader.get_data()
+        mtime_ns = os.stat(config_path).st_mtime_ns
+        config_dict = load_config_cache(config_path, mtime_ns)
+        if config_dict is None:
+            with open(config_path, "r") as config_file:
+                # JSON is a subset of YAML, but has a much faster parser
+                if config_path.endswith(".json"):
+                    config_dict = json.load(config_file)
+                else:
+                    config_dict = yaml.load(config_file, Loader=YAML_LOADER)
+            save_config_cache(config_path, mtime_ns, config_dict)
     except OSError as ex:
         log.error("An error ocurred during config file reading:")
         log.error(ex)
     except yaml.YAMLError as ex:
         log.error("An error ocurred during config YAML parsing:")
         log.error(ex)
+    except ValueError as ex:
+        log.error("An error ocurred during config JSON parsing:")
+        log.error(ex)
     return config_dict
 
 
-def find(data, value_path):
+def load_config_cache(config_path: str, mtime_ns: int) -> Optional[Dict[str, Any]]:
     """
-    Gets an element in a deeply nested data structure
+    Loads the parsed config saved next to the YAML file, if it was parsed from the
+    current version of the file. Unpickling can construct arbitrary objects, so the
+    cache is only as trustworthy as whoever can write to the config's directory
     """
 
-    keys = value_path.split('.')
-    inner = data
-    for key in keys:
-        if inner is None:
-            return None
-        else:
-            inner = inner.get(key)
-    return inner
+    try:
+        with open(f"{config_path}.cache", "rb") as cache_file:
+            cached = pickle.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:  # pylint: disable=broad-except
+        log.debug("Not using config cache: %s", ex)
+        return None
+    if not (isinstance(cached, tuple) and len(cached) == 2 and isinstance(cached[1], dict)):
+        log.debug("Not using config cache: unexpected contents")
+        return None
+    cached_mtime_ns, config_dict = cached
+    return config_dict if cached_mtime_ns == mtime_ns else None
+
+
+def save_config_cache(config_path: str, mtime_ns: int, config_dict: Dict[str, Any]) -> None:
+    """
+    Saves the parsed config next to the YAML file; written to a temporary file and renamed
+    so that a concurrent run never reads a partial cache
+    """
+
+    cache_path = f"{config_path}.cache"
+    try:
+        (handle, temp_path) = tempfile.mkstemp(dir=path.dirname(cache_path) or ".")
+        with os.fdopen(handle, "wb") as cache_file:
+            pickle.dump((mtime_ns, config_dict), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as ex:
+        log.warning("Could not save config cache to %s: %s", cache_path, ex)
+
+
+def find(data, keys):
+    """
+    Gets an element in a deeply nested data structure, given either a dotted
+    path or a pre-split tuple of keys
+    """
+
+    if isinstance(keys, str):
+        keys = keys.split('.')
+    return functools.reduce(
+        lambda inner, key: inner.get(key) if isinstance(inner, dict) else None,
+        keys, data)
 
 
 def load_file(config, value_path):
@@ -466,38 +612,90 @@ def load_file(config, value_path):
 
 def join_all():
     log.info("Joining threads")
-    for thread in thread_queue:
-        try:
-            thread.join()
-        except:
-            pass
+    if test_pool is not None:
+        test_pool.shutdown(wait=True)
+    if cloudlab is not None:
+        cloudlab.close()
+    quit_pooled_drivers()
 
 
 def join_then_quit():
     stop()
     join_all()
     log.info("Exiting")
-    sys.exit(1)
-
+    logging.shutdown()
+    # Runs off the main thread, where sys.exit would only end the calling thread
+    os._exit(1)
 
-def force_handler(_signum, _frame):
-    join_then_quit()
 
+class InterruptMonitor:
+    """
+    Handles SIGINTs on a background thread: the first asks whether to quit, another one
+    during that prompt quits (after joining the running tests) and any later one exits
+    immediately
+    """
 
-def exit_gracefully(_signum, _frame):
-    signal.signal(signal.SIGINT, force_handler)
-
-    try:
-        if input("\nReally quit? (y/n)>\n").lower().startswith('y'):
-            join_then_quit()
-
-    except KeyboardInterrupt:
-        join_then_quit()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = "running"
+
+    def install(self):
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(write_fd, False)
+        signal.set_wakeup_fd(write_fd)
+        # The handler itself does nothing; the monitor reacts to the signal number written
+        # to the wakeup fd instead
+        signal.signal(signal.SIGINT, lambda _signum, _frame: None)
+        threading.Thread(target=self._monitor, args=(read_fd,), name="interrupts",
+                         daemon=True).start()
+
+    def _monitor(self, read_fd):
+        while True:
+            for signum in os.read(read_fd, 64):
+                if signum == signal.SIGINT:
+                    self._interrupted()
+
+    def _interrupted(self):
+        with self._lock:
+            state = self._state
+            if state == "running":
+                self._state = "prompting"
+            elif state == "prompting":
+                self._state = "quitting"
+
+        if state == "running":
+            threading.Thread(target=self._prompt, name="quit-prompt", daemon=True).start()
+        elif state == "prompting":
+            self._quit()
+        else:
+            os._exit(1)
 
-    # restore the exit gracefully handler here
-    signal.signal(signal.SIGINT, exit_gracefully)
+    def _prompt(self):
+        # Reads the fd directly: input() would hold the stdin buffer lock, which aborts the
+        # interpreter if it exits normally while this daemon thread is still waiting
+        print("\nReally quit? (y/n)>", flush=True)
+        try:
+            answer = os.read(sys.stdin.fileno(), 1024)
+        except (OSError, ValueError):
+            answer = b""
+        # EOF quits as well
+        quitting = not answer or answer.lower().startswith(b"y")
+
+        with self._lock:
+            # Another interrupt during the prompt is already quitting
+            if self._state != "prompting":
+                return
+            self._state = "quitting" if quitting else "running"
+        if quitting:
+            self._quit()
+
+    @staticmethod
+    def _quit():
+        # Not a daemon (unlike the threads starting it), so that the interpreter waits for it
+        # if the main thread finishes first
+        threading.Thread(target=join_then_quit, name="quit", daemon=False).start()
 
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGINT, exit_gracefully)
+    InterruptMonitor().install()
     main()